@@ -77,6 +77,7 @@ def train_config():
     pretrain_n_mc_target = 1
     pretrain_n_mc_min = 0
     pretrain_n_mc_max = 10
+    pretrain_n_mc_batch = 1  # Descents per MCTS wave (virtual loss), 1 means sequential search
     pretrain_beamsize = 5
     pretrain_planning_mode = "mean"  # {"max", "mean"}, refers to PUCT
     pretrain_c_puct = 1.0
@@ -85,6 +86,7 @@ def train_config():
     train_n_mc_target = 1
     train_n_mc_min = 0
     train_n_mc_max = 20
+    train_n_mc_batch = 1
     train_beamsize = 5
     train_planning_mode = "mean"  # {"max", "mean"}, refers to PUCT
     train_c_puct = 1.0
@@ -103,6 +105,7 @@ def eval_config():
     eval_n_mc_target = 5
     eval_n_mc_min = 0
     eval_n_mc_max = 100
+    eval_n_mc_batch = 1
     eval_beamsize = 10
 
     eval_planning_mode = "mean"
@@ -110,6 +113,7 @@ def eval_config():
 
     eval_jets = 500
     eval_repeats = 1
+    eval_workers = 1
     eval_filename = "./data/eval/eval2.pickle"
     redraw_eval_jets = False
 
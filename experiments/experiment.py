@@ -123,6 +123,7 @@ def create_agent(
     train_n_mc_target,
     train_n_mc_min,
     train_n_mc_max,
+    train_n_mc_batch,
     train_planning_mode,
     train_c_puct,
     device,
@@ -146,6 +147,7 @@ def create_agent(
             n_mc_target=train_n_mc_target,
             n_mc_min=train_n_mc_min,
             n_mc_max=train_n_mc_max,
+            n_mc_batch=train_n_mc_batch,
             planning_mode=train_planning_mode,
             initialize_with_beam_search=initialize_mcts_with_beamsearch,
             log_likelihood_feature=log_likelihood_policy_input,
@@ -165,6 +167,7 @@ def create_agent(
             n_mc_target=train_n_mc_target,
             n_mc_min=train_n_mc_min,
             n_mc_max=train_n_mc_max,
+            n_mc_batch=train_n_mc_batch,
             planning_mode=train_planning_mode,
             initialize_with_beam_search=initialize_mcts_with_beamsearch,
             c_puct=train_c_puct,
@@ -183,6 +186,7 @@ def create_agent(
             n_mc_target=train_n_mc_target,
             n_mc_min=train_n_mc_min,
             n_mc_max=train_n_mc_max,
+            n_mc_batch=train_n_mc_batch,
             planning_mode=train_planning_mode,
             initialize_with_beam_search=initialize_mcts_with_beamsearch,
             c_puct=train_c_puct,
@@ -198,6 +202,7 @@ def create_agent(
             n_mc_target=train_n_mc_target,
             n_mc_min=train_n_mc_min,
             n_mc_max=train_n_mc_max,
+            n_mc_batch=train_n_mc_batch,
             planning_mode=train_planning_mode,
             initialize_with_beam_search=initialize_mcts_with_beamsearch,
             log_likelihood_feature=log_likelihood_policy_input,
@@ -258,6 +263,7 @@ def train(
     train_n_mc_target,
     train_n_mc_min,
     train_n_mc_max,
+    train_n_mc_batch,
     train_planning_mode,
     train_c_puct,
     train_steps,
@@ -269,6 +275,7 @@ def train(
     pretrain_n_mc_max,
     pretrain_n_mc_min,
     pretrain_n_mc_target,
+    pretrain_n_mc_batch,
     imitation_steps,
 ):
     """ Trains an agent """
@@ -287,6 +294,7 @@ def train(
             pretrain_planning_mode,
             pretrain_c_puct,
             pretrain_beamsize,
+            pretrain_n_mc_batch,
         )
         _ = env.reset()
         agent.learn(total_timesteps=pretrain_steps, callback=log_training)
@@ -294,7 +302,13 @@ def train(
         # Main training
         logger.info(f"Starting MCTS training for {train_steps} steps")
         agent.set_precision(
-            train_n_mc_target, train_n_mc_min, train_n_mc_max, train_planning_mode, train_c_puct, train_beamsize
+            train_n_mc_target,
+            train_n_mc_min,
+            train_n_mc_max,
+            train_planning_mode,
+            train_c_puct,
+            train_beamsize,
+            train_n_mc_batch,
         )
         _ = env.reset()
         agent.learn(total_timesteps=train_steps, callback=log_training)
@@ -312,7 +326,13 @@ def train(
         logger.info(f"Starting MCTS training for {train_steps} steps")
         _ = env.reset()
         agent.set_precision(
-            train_n_mc_target, train_n_mc_min, train_n_mc_max, train_planning_mode, train_c_puct, train_beamsize
+            train_n_mc_target,
+            train_n_mc_min,
+            train_n_mc_max,
+            train_planning_mode,
+            train_c_puct,
+            train_beamsize,
+            train_n_mc_batch,
         )
         agent.learn(total_timesteps=train_steps, callback=log_training)
     elif algorithm == "acer":
@@ -334,9 +354,11 @@ def eval(
     eval_n_mc_target,
     eval_n_mc_min,
     eval_n_mc_max,
+    eval_n_mc_batch,
     eval_planning_mode,
     eval_c_puct,
     eval_repeats,
+    eval_workers,
     eval_jets,
     eval_filename,
     redraw_eval_jets,
@@ -357,17 +379,29 @@ def eval(
     # Evaluate
     if algorithm in ["mcts", "lfd-mcts"]:
         agent.set_precision(
-            eval_n_mc_target, eval_n_mc_min, eval_n_mc_max, eval_planning_mode, eval_c_puct, eval_beamsize
+            eval_n_mc_target,
+            eval_n_mc_min,
+            eval_n_mc_max,
+            eval_planning_mode,
+            eval_c_puct,
+            eval_beamsize,
+            eval_n_mc_batch,
+        )
+        log_likelihood, errors, likelihood_evaluations = evaluator.eval(
+            name, agent, n_repeats=eval_repeats, n_workers=eval_workers
         )
-        log_likelihood, errors, likelihood_evaluations = evaluator.eval(name, agent, n_repeats=eval_repeats)
     elif algorithm == "lfd":
         log_likelihood, errors, likelihood_evaluations = evaluator.eval(
-            name, agent, n_repeats=eval_repeats, mode="policy"
+            name, agent, n_repeats=eval_repeats, mode="policy", n_workers=eval_workers
         )
     elif algorithm in ["acer", "random"]:
-        log_likelihood, errors, likelihood_evaluations = evaluator.eval(name, agent, n_repeats=eval_repeats)
+        log_likelihood, errors, likelihood_evaluations = evaluator.eval(
+            name, agent, n_repeats=eval_repeats, n_workers=eval_workers
+        )
     elif algorithm == "greedy":
-        log_likelihood, errors, likelihood_evaluations = evaluator.eval(name, agent, n_repeats=1)
+        log_likelihood, errors, likelihood_evaluations = evaluator.eval(
+            name, agent, n_repeats=1, n_workers=eval_workers
+        )
     elif algorithm == "beamsearch":
         log_likelihood, errors, likelihood_evaluations = evaluator.eval_beam_search(name, beam_size=eval_beamsize)
     elif algorithm == "truth":
@@ -139,10 +139,9 @@ class BatchedActorCriticAgent(Agent):
 
         self.sim_env.verbose = False
 
-        try:
-            _, _ = action
+        if self._action_is_tuple:
             log_likelihood = self.sim_env._compute_log_likelihood(action)
-        except TypeError:
+        else:
             log_likelihood = self.sim_env._compute_log_likelihood(self.sim_env.unwrap_action(action))
 
         self.episode_likelihood_evaluations += 1
@@ -2,6 +2,7 @@ import numpy as np
 import torch
 from torch import nn
 import logging
+from gym.spaces import MultiDiscrete
 from tqdm import trange
 
 from ..utils.replay_buffer import History
@@ -33,8 +34,9 @@ class Agent(nn.Module):
         self.dtype = dtype
         self.action_space = env.action_space
         self.state_shape = env.observation_space.shape
-        self.state_length = np.product(self.state_shape)
+        self.state_length = int(np.product(self.state_shape))
         self.num_actions = self.action_space.n
+        self._action_is_tuple = self._has_tuple_actions(env)
         self._init_replay_buffer(history_length)
         self.optimizer = None
         self.lr = lr
@@ -46,6 +48,7 @@ class Agent(nn.Module):
 
     def set_env(self, env):
         self.env = env
+        self._action_is_tuple = self._has_tuple_actions(env)
 
     def learn(self, total_timesteps, callback=None):
         # Prepare training
@@ -170,6 +173,11 @@ class Agent(nn.Module):
         self.optimizer.step()
         self.scheduler.step()
 
+    @staticmethod
+    def _has_tuple_actions(env):
+        """ Whether env expects actions as tuples (i, j), rather than as integers as in the 1D-wrapped envs """
+        return isinstance(env.action_space, MultiDiscrete)
+
     def _find_legal_actions(self, state):
         # Compatibility with torch tensors and numpy arrays
         try:
@@ -1,4 +1,3 @@
-import copy
 import logging
 
 from .base import Agent
@@ -10,14 +9,14 @@ class GreedyAgent(Agent):
     def __init__(self, *args, verbose=0, **kwargs):
         super().__init__(*args, **kwargs)
         self.verbose = verbose
-        self.sim_env = copy.deepcopy(self.env)
+        self.sim_env = self.env.clone()
         self.sim_env.reset_at_episode_end = False  # Avoids expensive re-sampling of jets every time we parse a path
 
         self.episode_likelihood_evaluations = 0
 
     def set_env(self, env):
         self.env = env
-        self.sim_env = copy.deepcopy(self.env)
+        self.sim_env = self.env.clone()
         self.sim_env.reset_at_episode_end = False  # Avoids expensive re-sampling of jets every time we parse a path
 
     def _predict(self, state):
@@ -28,9 +28,9 @@ class ImitationLearningPolicyMCTSAgent(PolicyMCTSAgent):
     def _predict_policy(self, state, demonstrator_action=None):
         state = self._tensorize(state)
         legal_actions = self._find_legal_actions(state)
-        step_rewards = [self._parse_action(action, from_which_env="real") for action in legal_actions]
+        step_rewards = list(self._parse_actions(legal_actions, from_which_env="real"))
 
-        probs = self._evaluate_policy(state, legal_actions, step_rewards)
+        probs = self._evaluate_policy(state, legal_actions, step_rewards, for_training=True)
         probs = torch.clamp(probs, 1.0e-6, 1.0)
         try:
             cat = Categorical(probs)
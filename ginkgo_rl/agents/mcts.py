@@ -1,10 +1,10 @@
 import torch
 from torch import nn
-import copy
 import logging
 import numpy as np
 
 from ginkgo_rl.utils.mcts import MCTSNode
+from ginkgo_rl.utils import mcts_kernels
 from .base import Agent
 from ..utils.nets import MultiHeadedMLP
 from ..utils.various import check_for_nans, NanException
@@ -19,6 +19,7 @@ class BaseMCTSAgent(Agent):
         n_mc_target=5,
         n_mc_min=5,
         n_mc_max=100,
+        n_mc_batch=1,
         planning_mode="mean",
         decision_mode="max_reward",
         c_puct=1.0,
@@ -30,9 +31,13 @@ class BaseMCTSAgent(Agent):
     ):
         super().__init__(*args, **kwargs)
 
+        if n_mc_batch < 1:
+            raise ValueError(f"n_mc_batch has to be at least 1, but is {n_mc_batch}")
+
         self.n_mc_target = n_mc_target
         self.n_mc_min = n_mc_min
         self.n_mc_max = n_mc_max
+        self.n_mc_batch = n_mc_batch
         self.planning_mode = planning_mode
         self.decision_mode = decision_mode
         self.c_puct = c_puct
@@ -42,28 +47,40 @@ class BaseMCTSAgent(Agent):
         self.reward_range = reward_range
         self.verbose = verbose
 
-        self.sim_env = copy.deepcopy(self.env)
+        self.sim_env = self.env.clone()
         self.sim_env.reset_at_episode_end = False  # Avoids expensive re-sampling of jets every time we parse a path
+        self._sim_env_sync = None  # State versions of (self.env, self.sim_env) when they were last synchronized
+        self._sim_env_node = None  # Node whose state self.sim_env is in, with the sim_env state version at the time
 
+        self.mcts_head = None
         self.episode_reward = 0.0
         self.episode_likelihood_evaluations = 0
         self.init_episode()
 
+        mcts_kernels.warm_up()  # Compiles the selection kernels now rather than during the first tree search
+
     def set_env(self, env):
         """ Sets current environment (and initializes episode) """
 
         self.env = env
-        self.sim_env = copy.deepcopy(self.env)
+        self._action_is_tuple = self._has_tuple_actions(env)
+        self.sim_env = self.env.clone()
         self.sim_env.reset_at_episode_end = False  # Avoids expensive re-sampling of jets every time we parse a path
+        self._sim_env_sync = None
+        self._sim_env_node = None
         self.init_episode()
 
-    def set_precision(self, n_mc_target, n_mc_min, n_mc_max, planning_mode, c_puct, beam_size):
-        """ Sets / changes MCTS precision parameters """
+    def set_precision(self, n_mc_target, n_mc_min, n_mc_max, planning_mode, c_puct, beam_size, n_mc_batch=None):
+        """ Sets / changes MCTS precision parameters (n_mc_batch=None keeps the current batch size) """
+
+        if n_mc_batch is not None:
+            if n_mc_batch < 1:
+                raise ValueError(f"n_mc_batch has to be at least 1, but is {n_mc_batch}")
+            self.n_mc_batch = n_mc_batch
 
         self.n_mc_target = n_mc_target
         self.n_mc_min = n_mc_min
         self.n_mc_max = n_mc_max
-        self.n_mc_max = n_mc_max
         self.planning_mode = planning_mode
         self.c_puct = c_puct
         self.beam_size = beam_size
@@ -71,7 +88,11 @@ class BaseMCTSAgent(Agent):
     def init_episode(self):
         """ Initializes MCTS tree and total reward so far """
 
-        self.mcts_head = MCTSNode(None, [], reward_min=self.reward_range[0], reward_max=self.reward_range[1])
+        if self.mcts_head is not None:
+            MCTSNode.release_tree(self.mcts_head)  # Recycle the nodes of the old tree
+        self._sim_env_node = None
+
+        self.mcts_head = MCTSNode.acquire(None, [], reward_min=self.reward_range[0], reward_max=self.reward_range[1])
         self.episode_reward = 0.0
         self.episode_likelihood_evaluations = 0
 
@@ -87,8 +108,9 @@ class BaseMCTSAgent(Agent):
 
         # Update MCTS tree
         if not done:
-            self.mcts_head = self.mcts_head.children[action]
-            self.mcts_head.prune()  # This updates the node.path
+            self.mcts_head = self.mcts_head.child(action)
+            self.mcts_head.prune()  # This updates the node.path and recycles the discarded branches
+            self._sim_env_node = None
 
         # Train
         if self.training:
@@ -101,49 +123,68 @@ class BaseMCTSAgent(Agent):
         pass
 
     def _predict(self, state):
-        if self.initialize_with_beam_search:
-            self._beam_search(state)
-        action, info = self._mcts(state)
+        # Parse and expand root
+        this_state, _, terminal = self._parse_path(self.mcts_head)
+        if not self._mcts_expand(self.mcts_head, this_state, terminal):
+            raise RuntimeError(f"Cannot choose an action in terminal state {state}")
+
+        if len(self.mcts_head) == 1:  # Forced move, no need to search
+            action, info = self.mcts_head.legal_actions[0], {"log_prob": torch.tensor(0.0, dtype=self.dtype)}
+            if self.verbose > 0:
+                logger.debug(f"Only one legal action: {action}")
+        else:
+            if self.initialize_with_beam_search:
+                self._beam_search(state)
+            action, info = self._mcts(state)
+
         info["likelihood_evaluations"] = self.episode_likelihood_evaluations
         return action, info
 
-    def _parse_path(self, state, path, from_which_env="real"):
-        """ Given a path (list of actions), computes the resulting environment state and total reward.
+    def _parse_path(self, node):
+        """ Given a tree node, computes the resulting environment state, the total reward since the beginning of the
+        episode, and whether the state is terminal. Leaves self.sim_env in that state.
 
-        `from_which_env` defines the start point (either "sim" for self.sim_env, or "real" for self.env) """
+        The result is cached in the node, so in practice only the last action of the path has to be simulated. """
 
-        if from_which_env == "real":  # Start in self.env state
-            if self.sim_env.state is None or not np.all(np.isclose(self.sim_env.state, self.env.state)):
-                self.sim_env.set_internal_state(self.env.get_internal_state())
-        elif from_which_env == "sim":  # Use current state of self.sim_env
-            pass
-        else:
-            raise ValueError(from_which_env)
+        # Find closest ancestor with cached environment state
+        uncached = []
+        while node.snapshot is None and node.parent is not None:
+            uncached.append(node)
+            node = node.parent
 
-        self.sim_env.verbose = False
+        sim_env, tensorize = self.sim_env, self._tensorize
+        sim_env.verbose = False
 
-        # Follow path
-        total_reward = 0.0
-        terminal = False
+        if node.snapshot is None:  # Tree root, start in self.env state
+            self._sync_sim_env()
+            node.cache(sim_env.get_internal_state(), tensorize(sim_env.state), self.episode_reward, False)
+        else:
+            sim_env.set_internal_state(node.snapshot)
 
-        for action in path:
-            state, reward, done, info = self.sim_env.step(action)
-            total_reward += reward
-            self.episode_likelihood_evaluations += 1
+        state, total_reward, terminal = node.state, node.total_reward, node.terminal
 
-            if done:
-                terminal = True
-                break
+        # Follow remaining path (nodes below a terminal state are never created, so the path does not end early)
+        if uncached:
+            state, reward, terminal = sim_env.step_many([node.path[-1] for node in reversed(uncached)])
+            total_reward += reward
+            state = tensorize(state)
+            node = uncached[0]
+            node.cache(sim_env.get_internal_state(), state, total_reward, terminal)
+            self.episode_likelihood_evaluations += len(uncached)
 
-        state = self._tensorize(state)
+        self._sim_env_node = (node, sim_env.state_version)
         return state, total_reward, terminal
 
     def _parse_action(self, action, from_which_env="sim"):
         """ Given a state and an action, computes the log likelihood """
 
+        return self._parse_actions([action], from_which_env=from_which_env)[0]
+
+    def _parse_actions(self, actions, from_which_env="sim"):
+        """ Given a state and a list of actions, computes the log likelihoods (as ndarray) """
+
         if from_which_env == "real":  # Start in self.env state
-            if self.sim_env.state is None or not np.all(np.isclose(self.sim_env.state, self.env.state)):
-                self.sim_env.set_internal_state(self.env.get_internal_state())
+            self._sync_sim_env()
         elif from_which_env == "sim":  # Use current state of self.sim_env
             pass
         else:
@@ -151,80 +192,99 @@ class BaseMCTSAgent(Agent):
 
         self.sim_env.verbose = False
 
-        try:
-            _, _ = action
-            log_likelihood = self.sim_env._compute_log_likelihood(action)
-        except TypeError:
-            log_likelihood = self.sim_env._compute_log_likelihood(self.sim_env.unwrap_action(action))
+        if not self._action_is_tuple:
+            actions = [self.sim_env.unwrap_action(action) for action in actions]
+
+        log_likelihoods = self.sim_env._compute_log_likelihoods(actions)
+
+        self.episode_likelihood_evaluations += len(actions)
+        return log_likelihoods
 
-        self.episode_likelihood_evaluations += 1
-        return log_likelihood
+    def _sync_sim_env(self):
+        """ Sets self.sim_env to the state of self.env, unless neither has changed since they were last synchronized """
+
+        if self._sim_env_sync != (self.env.state_version, self.sim_env.state_version):
+            self.sim_env.set_internal_state(self.env.get_internal_state())
+            self._sim_env_sync = (self.env.state_version, self.sim_env.state_version)
 
     def _mcts(self, state, max_steps=1000):
-        """ Run Monte-Carl tree search from state for n trajectories"""
+        """ Run Monte-Carl tree search from state for n trajectories.
+
+        The trajectories are processed in waves of (up to) `n_mc_batch` descents that walk down the tree in lockstep,
+        so that the policy can be evaluated for all of them in a single batch. """
+
+        # Local names for everything used in the inner loops
+        head, n_mc_batch, planning_mode, c_puct = self.mcts_head, self.n_mc_batch, self.planning_mode, self.c_puct
+        parse_path, expand, evaluate_policies = self._parse_path, self._mcts_expand, self._evaluate_policies
+        debug = self.verbose > 1 and logger.isEnabledFor(logging.DEBUG)
 
         n_initial_legal_actions = len(self._find_legal_actions(state))
-        n = min(max(self.n_mc_target * n_initial_legal_actions - self.mcts_head.n, self.n_mc_min), self.n_mc_max)
+        n = min(max(self.n_mc_target * n_initial_legal_actions - head.n, self.n_mc_min), self.n_mc_max)
         logger.debug(f"Starting MCTS with {n} trajectories")
 
-        for i in range(n):
-            if self.verbose > 1:
-                logger.debug(f"Initializing MCTS trajectory {i+1} / {n}")
-            node = self.mcts_head
-            total_reward = 0.0
+        for wave_start in range(0, n, n_mc_batch):
+            wave_size = min(n_mc_batch, n - wave_start)
+            if debug:
+                logger.debug(f"Initializing MCTS trajectories {wave_start + 1} to {wave_start + wave_size} / {n}")
+
+            # Parse root; each trajectory is represented by the list of nodes it has visited
+            this_state, _, terminal = parse_path(head)
+            head.add_virtual_loss(wave_size)
+            trajectories = [[head] for _ in range(wave_size)]
+            if expand(head, this_state, terminal):
+                active, finished = trajectories, []
+            else:
+                active, finished = [], trajectories
 
             for _ in range(max_steps):
-                # Parse current state
-                if len(node.path) == 0:
-                    this_state, total_reward, terminal = self._parse_path(state, node.path)
-                else:  # We can speed this up by just doing a single step in self.sim_env
-                    this_state, last_step_reward, terminal = self._parse_path(
-                        this_state, node.path[-1:], from_which_env="sim"
-                    )
-                    total_reward += last_step_reward
-
-                node.set_terminal(terminal)
-                if self.verbose > 1:
-                    logger.debug(f"  Node {node.path}")
-
-                # Termination
-                if terminal:
-                    if self.verbose > 1:
-                        logger.debug(f"  Node is terminal")
+                if not active:
                     break
 
-                # Expand
-                if not node.children:
-                    actions = self._find_legal_actions(this_state)
-                    if self.verbose > 1:
-                        logger.debug(f"    Expanding: {len(actions)} legal actions")
-                    step_rewards = [self._parse_action(action, from_which_env="sim") for action in actions]
-                    node.expand(actions, step_rewards=step_rewards)
-
-                    if not node.children:
-                        logger.warning(
-                            f"Did not find any legal actions even though state was not recognized as terminal. "
-                            f"Node path: {node.path}. Children: {node.children}. State: {this_state}. Actions: {actions}."
-                        )
-                        node.set_terminal(True)
-                        break
-
-                # Select
-                policy_probs = self._evaluate_policy(
-                    this_state, node.children.keys(), step_rewards=node.children_q_steps()
-                )
-                action = node.select_puct(policy_probs, mode=self.planning_mode, c_puct=self.c_puct)
-                if self.verbose > 1:
-                    logger.debug(f"    Selecting action {action}")
-                node = node.children[action]
+                # Evaluate policy for all distinct nodes in a single batch (except for forced moves)
+                unique = {}
+                for visited in active:
+                    if len(visited[-1]) > 1:
+                        unique.setdefault(id(visited[-1]), visited[-1])
+                if unique:
+                    policy_probs = evaluate_policies(
+                        [node.state for node in unique.values()],
+                        [node.legal_actions for node in unique.values()],
+                        [node.children_q_steps() for node in unique.values()],
+                    )
+                    policy_probs = dict(zip(unique.keys(), policy_probs))
+
+                # Select, step, and expand. The virtual loss makes later descents in the wave avoid the children
+                # chosen by earlier ones.
+                next_active = []
+                for visited in active:
+                    node = visited[-1]
+                    if len(node) == 1:
+                        action = node.legal_actions[0]
+                    else:
+                        action = node.select_puct(policy_probs[id(node)], mode=planning_mode, c_puct=c_puct)
+                    if debug:
+                        logger.debug(f"  Node {node.path}: selecting action {action}")
+                    node = node.child(action)
+                    node.add_virtual_loss()
+                    visited.append(node)
+
+                    this_state, _, terminal = parse_path(node)
+                    if expand(node, this_state, terminal):
+                        next_active.append(visited)
+                    else:
+                        finished.append(visited)
+
+                active = next_active
 
             # Backup
-            if self.verbose > 1:
-                logger.debug(f"  Backing up total reward of {total_reward}")
-            node.give_reward(self.episode_reward + total_reward, backup=True)
+            for visited in finished + active:
+                total_reward = visited[-1].total_reward
+                if debug:
+                    logger.debug(f"  Backing up total reward of {total_reward} from node {visited[-1].path}")
+                MCTSNode.backup(visited[::-1], total_reward, remove_virtual_loss=True)
 
         # Select best action
-        legal_actions = list(self.mcts_head.children.keys())
+        legal_actions = self.mcts_head.legal_actions
         if not legal_actions:
             legal_actions = self._find_legal_actions(state)
         step_rewards = self.mcts_head.children_q_steps()
@@ -240,7 +300,9 @@ class BaseMCTSAgent(Agent):
         else:
             raise ValueError(self.decision_mode)
 
-        log_prob = torch.log(self._evaluate_policy(state, legal_actions, step_rewards=step_rewards, action=action))
+        log_prob = torch.log(
+            self._evaluate_policy(state, legal_actions, step_rewards=step_rewards, action=action, for_training=True)
+        )
         info = {"log_prob": log_prob}
 
         # Debug output
@@ -249,47 +311,80 @@ class BaseMCTSAgent(Agent):
 
         return action, info
 
+    def _mcts_expand(self, node, this_state, terminal):
+        """ Marks a node as terminal or expands it, returns whether a MCTS trajectory can continue from it """
+
+        node.set_terminal(terminal)
+        if terminal:
+            if self.verbose > 1 and logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"  Node {node.path} is terminal")
+            return False
+
+        self._expand_node(node, this_state)
+        if len(node) == 0:
+            logger.warning(
+                f"Did not find any legal actions even though state was not recognized as terminal. "
+                f"Node path: {node.path}. State: {this_state}."
+            )
+            node.set_terminal(True)
+            return False
+
+        return True
+
+    def _expand_node(self, node, this_state):
+        """ Expands a node, unless it has already been expanded: finds the legal actions and computes their log
+        likelihoods in a single batch, with self.sim_env restored to the node's state at most once """
+
+        if node.expanded:
+            return
+
+        if self._sim_env_node != (node, self.sim_env.state_version):  # Usually _parse_path(node) has just left it there
+            self.sim_env.set_internal_state(node.snapshot)
+
+        actions = self._find_legal_actions(this_state)
+        if self.verbose > 1 and logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"    Expanding: {len(actions)} legal actions")
+        step_rewards = self._parse_actions(actions, from_which_env="sim")
+        node.expand(actions, step_rewards=step_rewards)
+
     def _greedy(self, state):
         """ Expands MCTS tree using a greedy algorithm """
 
+        debug = self.verbose > 1 and logger.isEnabledFor(logging.DEBUG)
         node = self.mcts_head
-        if self.verbose > 1:
+        if debug:
             logger.debug(f"Starting greedy algorithm.")
 
         while not node.terminal:
             # Parse current state
-            this_state, total_reward, terminal = self._parse_path(state, node.path)
+            this_state, total_reward, terminal = self._parse_path(node)
             node.set_terminal(terminal)
-            if self.verbose > 1:
+            if debug:
                 logger.debug(f"  Analyzing node {node.path}")
 
             # Expand
-            if not node.terminal and not node.children:
-                actions = self._find_legal_actions(this_state)
-                step_rewards = [self._parse_action(action, from_which_env="sim") for action in actions]
-                if self.verbose > 1:
-                    logger.debug(f"    Expanding: {len(actions)} legal actions")
-                node.expand(actions, step_rewards=step_rewards)
+            if not node.terminal:
+                self._expand_node(node, this_state)
 
             # If terminal, backup reward
             if node.terminal:
-                if self.verbose > 1:
+                if debug:
                     logger.debug(f"    Node is terminal")
-                if self.verbose > 1:
+                if debug:
                     logger.debug(f"    Backing up total reward {total_reward}")
-                node.give_reward(self.episode_reward + total_reward, backup=True)
+                node.give_reward(total_reward, backup=True)
 
             # Debugging -- this should not happen
-            if not node.terminal and not node.children:
+            if not node.terminal and len(node) == 0:
                 logger.warning(
-                    f"Unexpected lack of children! Path: {node.path}, children: {node.children.keys()}, legal actions: {self._find_legal_actions(this_state)}, terminal: {node.terminal}"
+                    f"Unexpected lack of children! Path: {node.path}, children: {node.legal_actions}, legal actions: {self._find_legal_actions(this_state)}, terminal: {node.terminal}"
                 )
                 node.set_terminal(True)
 
             # Greedily select next action
             if not node.terminal:
                 action = node.select_greedy()
-                node = node.children[action]
+                node = node.child(action)
 
         if self.verbose > 0:
             choice = self.mcts_head.select_best(mode="max")
@@ -298,61 +393,73 @@ class BaseMCTSAgent(Agent):
     def _beam_search(self, state):
         """ Expands MCTS tree using beam search """
 
-        beam = [(self.episode_reward, self.mcts_head)]
-        next_beam = []
+        beam_size = self.beam_size
+        debug = self.verbose > 1 and logger.isEnabledFor(logging.DEBUG)
+        beam = [self.mcts_head]
 
         def format_beam():
-            return [node.path for _, node in beam]
+            return [node.path for node in beam]
 
-        if self.verbose > 1:
-            logger.debug(f"Starting beam search with beam size {self.beam_size}. Initial beam: {format_beam()}")
+        if debug:
+            logger.debug(f"Starting beam search with beam size {beam_size}. Initial beam: {format_beam()}")
 
-        while beam or next_beam:
-            for i, (_, node) in enumerate(beam):
+        while beam:
+            # Candidates for the next step (total rewards and nodes), each node at most once
+            next_rewards, next_beam, seen = [], [], set()
+
+            for i, node in enumerate(beam):
                 # Parse current state
-                this_state, total_reward, terminal = self._parse_path(state, node.path)
+                this_state, total_reward, terminal = self._parse_path(node)
                 node.set_terminal(terminal)
-                if self.verbose > 1:
+                if debug:
                     logger.debug(f"  Analyzing node {i+1} / {len(beam)} on beam: {node.path}")
 
                 # Expand
-                if not node.terminal and not node.children:
-                    actions = self._find_legal_actions(this_state)
-                    step_rewards = [self._parse_action(action, from_which_env="sim") for action in actions]
-                    if self.verbose > 1:
-                        logger.debug(f"    Expanding: {len(actions)} legal actions")
-                    node.expand(actions, step_rewards=step_rewards)
+                if not node.terminal:
+                    self._expand_node(node, this_state)
 
                 # If terminal, backup reward
                 if node.terminal:
-                    if self.verbose > 1:
+                    if debug:
                         logger.debug(f"    Node is terminal")
-                    if self.verbose > 1:
+                    if debug:
                         logger.debug(f"    Backing up total reward {total_reward}")
-                    node.give_reward(self.episode_reward + total_reward, backup=True)
+                    node.give_reward(total_reward, backup=True)
 
                 # Did we already process this one? Then skip it
-                if node.n_beamsearch >= self.beam_size:
-                    if self.verbose > 1:
+                if node.n_beamsearch >= beam_size:
+                    if debug:
                         logger.debug(f"    Already beam searched this node sufficiently")
                     continue
 
                 # Beam search selection
-                for action in node.select_beam_search(self.beam_size):
-                    next_reward = total_reward + node.children[action].q_step
-                    next_node = node.children[action]
-                    next_beam.append((next_reward, next_node))
+                for action in node.select_beam_search(beam_size):
+                    next_node = node.child(action)
+                    if id(next_node) in seen:
+                        continue
+                    seen.add(id(next_node))
+                    next_rewards.append(total_reward + next_node.q_step)
+                    next_beam.append(next_node)
 
                 # Mark as visited
                 node.in_beam = True
 
-            # Just keep top entries for next step
-            beam = sorted(next_beam, key=lambda x: x[0], reverse=True)[: self.beam_size]
-            if self.verbose > 1:
+            # Just keep top entries for next step. A partition is O(m), and only the selected entries are sorted.
+            # Ties at the cutoff are resolved in favor of earlier candidates, like a stable sort would.
+            next_rewards = -np.asarray(next_rewards, dtype=np.float64)
+            if len(next_beam) > beam_size:
+                cutoff = np.partition(next_rewards, beam_size - 1)[beam_size - 1]
+                better, tied = np.flatnonzero(next_rewards < cutoff), np.flatnonzero(next_rewards == cutoff)
+                selected = np.sort(np.concatenate((better, tied[: beam_size - len(better)])))
+            else:
+                selected = np.arange(len(next_beam))
+            selected = selected[np.argsort(next_rewards[selected], kind="stable")]
+            beam = [next_beam[i] for i in selected]
+
+            if debug:
                 logger.debug(
-                    f"Preparing next step, keeping {self.beam_size} / {len(next_beam)} nodes in beam: {format_beam()}"
+                    f"Preparing next step, keeping {beam_size} / {len(next_beam)} nodes in beam: {format_beam()}"
                 )
-            next_beam = []
 
         logger.debug(f"Finished beam search")
 
@@ -361,13 +468,16 @@ class BaseMCTSAgent(Agent):
             self._report_decision(choice, state, "Beam search")
 
     def _report_decision(self, chosen_action, state, label="MCTS"):
-        legal_actions = self._find_legal_actions(state)
-        probs = self._evaluate_policy(state, legal_actions)
+        legal_actions = self.mcts_head.legal_actions
+        step_rewards = self.mcts_head.children_q_steps()
+        probs = self._evaluate_policy(state, legal_actions, step_rewards=step_rewards)
+        greedy_action = legal_actions[int(np.argmax(step_rewards))]
 
         logger.debug(f"{label} results:")
-        for i, (action_, node_) in enumerate(self.mcts_head.children.items()):
+        for i, action_ in enumerate(legal_actions):
+            node_ = self.mcts_head.child(action_)
             is_chosen = "*" if action_ == chosen_action else " "
-            is_greedy = "g" if action_ == np.argmax(self.mcts_head.children_q_steps()) else " "
+            is_greedy = "g" if action_ == greedy_action else " "
             logger.debug(
                 f" {is_chosen}{is_greedy} {action_:>2d}: "
                 f"log likelihood = {node_.q_step:6.2f}, "
@@ -377,10 +487,19 @@ class BaseMCTSAgent(Agent):
                 f"max = {node_.q_max:>5.1f} [{node_.get_reward(mode='max'):>4.2f}]"
             )
 
-    def _evaluate_policy(self, state, legal_actions, step_rewards=None, action=None):
-        """ Evaluates the policy on the state and returns the probabilities for a given action or all legal actions """
+    def _evaluate_policy(self, state, legal_actions, step_rewards=None, action=None, for_training=False):
+        """ Evaluates the policy on the state and returns the probabilities for a given action or all legal actions.
+
+        Only if `for_training` is True, the computation is tracked by autograd. """
         raise NotImplementedError
 
+    def _evaluate_policies(self, states, legal_actions_list, step_rewards_list, for_training=False):
+        """ Evaluates the policy on a batch of states and returns a list with the probabilities of all legal actions """
+        return [
+            self._evaluate_policy(state, legal_actions, step_rewards=step_rewards, for_training=for_training)
+            for state, legal_actions, step_rewards in zip(states, legal_actions_list, step_rewards_list)
+        ]
+
     def _train(self, log_prob):
         """ Policy updates at end of each step, returns loss """
         raise NotImplementedError
@@ -395,6 +514,7 @@ class PolicyMCTSAgent(BaseMCTSAgent):
         activation=nn.ReLU(),
         action_factor=0.01,
         log_likelihood_factor=0.1,
+        script_actor=True,
         **kwargs,
     ):
         super().__init__(*args, **kwargs)
@@ -408,80 +528,96 @@ class PolicyMCTSAgent(BaseMCTSAgent):
             activation=activation,
             head_activations=(None,),
         )
+        if script_actor:  # The actor is called for many small batches, TorchScript removes the Python overhead
+            self.actor = torch.jit.script(self.actor)
         self.softmax = nn.Softmax(dim=0)
 
         self.action_factor = action_factor
         self.log_likelihood_factor = log_likelihood_factor
 
-    def _evaluate_policy(self, state, legal_actions, step_rewards=None, action=None):
+    def _evaluate_policy(self, state, legal_actions, step_rewards=None, action=None, for_training=False):
+        (probs,) = self._evaluate_policies([state], [legal_actions], [step_rewards], for_training=for_training)
+
+        if action is not None:
+            assert action in legal_actions
+            return probs[legal_actions.index(action)]
+
+        return probs
+
+    def _evaluate_policies(self, states, legal_actions_list, step_rewards_list, for_training=False):
         try:
-            policy_input = self._prepare_policy_input(state, legal_actions, step_rewards=step_rewards)
+            policy_input = torch.cat(
+                [
+                    self._prepare_policy_input(state, legal_actions, step_rewards=step_rewards)
+                    for state, legal_actions, step_rewards in zip(states, legal_actions_list, step_rewards_list)
+                ],
+                dim=0,
+            )
             check_for_nans("Policy input", policy_input)
-            (probs,) = self.actor(policy_input)
-            check_for_nans("Policy probabilities", probs)
-            probs = self.softmax(probs).flatten()
+
+            # Policy evaluations during the tree search do not need gradients
+            with torch.set_grad_enabled(for_training and torch.is_grad_enabled()):
+                (probs,) = self.actor(policy_input)
+                check_for_nans("Policy probabilities", probs)
+                probs = probs.flatten()
+                probs = [
+                    self.softmax(x) for x in torch.split(probs, [len(actions) for actions in legal_actions_list])
+                ]
         except NanException:
             logger.error("NaNs appeared when evaluating the policy.")
-            logger.error(f"  state:             {state}")
-            logger.error(f"  legal actions:     {legal_actions}")
-            logger.error(f"  step rewards:      {step_rewards}")
-            logger.error(f"  action:            {action}")
+            logger.error(f"  states:            {states}")
+            logger.error(f"  legal actions:     {legal_actions_list}")
+            logger.error(f"  step rewards:      {step_rewards_list}")
             logger.error(f"  policy weights:    {list(self.parameters())}")
             logger.error(f"  mean weight:       {self.get_mean_weight()}")
 
             raise
 
-        if action is not None:
-            assert action in legal_actions
-            return probs[legal_actions.index(action)]
-
         return probs
 
     def _prepare_policy_input(self, state, legal_actions, step_rewards=None):
         """ Prepares the input to the policy """
         check_for_nans("Raw state", state)
-        state_ = state.view(-1)
+        state_ = state.cpu().numpy()
 
-        if step_rewards is None or not step_rewards:
+        if step_rewards is None or len(step_rewards) == 0:
             step_rewards = [None for _ in legal_actions]
-        batch_states = []
 
         assert legal_actions
-        assert step_rewards
+        assert len(step_rewards) > 0
         assert len(legal_actions) == len(step_rewards)
 
-        for action, log_likelihood in zip(legal_actions, step_rewards):
-            action_ = self.action_factor * torch.tensor([action]).to(self.device, self.dtype)
-
-            i, j = self.env.unwrap_action(action)
-            pi = state[i, :]
-            pj = state[j, :]
-            check_for_nans("Individual momenta", pi, pj)
-
-            if self.log_likelihood_feature:
-                if log_likelihood is None:
-                    log_likelihood = self._parse_action(action, from_which_env="real")
-                if not np.isfinite(log_likelihood):
-                    log_likelihood = 0.0
-                log_likelihood = np.clip(log_likelihood, self.reward_range[0], self.reward_range[1])
-                log_likelihood_ = self.log_likelihood_factor * torch.tensor([log_likelihood]).to(
-                    self.device, self.dtype
+        state_length, log_likelihood_feature = self.state_length, self.log_likelihood_feature
+        unwrap_action = self.env.unwrap_action
+
+        # Fill a single array with one row per action: action, both particle momenta, (log likelihood,) full state
+        batch_states = np.empty((len(legal_actions), 1 + 8 + int(log_likelihood_feature) + state_length))
+        particles = np.array([unwrap_action(action) for action in legal_actions], dtype=np.int64)
+        batch_states[:, 0] = self.action_factor * np.asarray(legal_actions)
+        batch_states[:, 1:5] = state_[particles[:, 0]]
+        batch_states[:, 5:9] = state_[particles[:, 1]]
+        batch_states[:, -state_length:] = state_.reshape(1, -1)
+
+        if log_likelihood_feature:
+            log_likelihoods = np.array(step_rewards, dtype=np.float64)  # None becomes NaN
+            missing = [i for i, log_likelihood in enumerate(step_rewards) if log_likelihood is None]
+            if missing:
+                log_likelihoods[missing] = self._parse_actions(
+                    [legal_actions[i] for i in missing], from_which_env="real"
                 )
-                check_for_nans("Log likelihood as policy input", log_likelihood_)
-
-                combined_state = torch.cat((action_, pi, pj, log_likelihood_, state_), dim=0)
-                check_for_nans("Individual policy input entry", combined_state)
-            else:
-                combined_state = torch.cat((action_, pi, pj, state_), dim=0)
-                check_for_nans("Individual policy input entry", combined_state)
-
-            batch_states.append(combined_state.unsqueeze(0))
+            reward_min, reward_max = self.reward_range
+            log_likelihoods[~np.isfinite(log_likelihoods)] = 0.0
+            log_likelihoods = np.clip(log_likelihoods, reward_min, reward_max)
+            batch_states[:, 9] = self.log_likelihood_factor * log_likelihoods
 
-        batch_states = torch.cat(batch_states, dim=0)
+        batch_states = torch.from_numpy(batch_states).to(self.device, self.dtype)
         check_for_nans("Concatenated policy input", batch_states)
         return batch_states
 
     def _train(self, log_prob):
+        if not log_prob.requires_grad:  # Forced moves do not depend on the policy
+            return 0.0
+
         loss = -log_prob
         check_for_nans("Loss", loss)
         self._gradient_step(loss)
@@ -493,7 +629,7 @@ class PolicyMCTSAgent(BaseMCTSAgent):
 
 
 class RandomMCTSAgent(BaseMCTSAgent):
-    def _evaluate_policy(self, state, legal_actions, step_rewards=None, action=None):
+    def _evaluate_policy(self, state, legal_actions, step_rewards=None, action=None, for_training=False):
         """ Evaluates the policy on the state and returns the probabilities for a given action or all legal actions """
         if action is not None:
             return torch.tensor(1.0 / len(legal_actions), dtype=self.dtype)
@@ -505,7 +641,7 @@ class RandomMCTSAgent(BaseMCTSAgent):
 
 
 class LikelihoodMCTSAgent(BaseMCTSAgent):
-    def _evaluate_policy(self, state, legal_actions, step_rewards=None, action=None):
+    def _evaluate_policy(self, state, legal_actions, step_rewards=None, action=None, for_training=False):
         """ Evaluates the policy on the state and returns the probabilities for a given action or all legal actions """
         assert step_rewards is not None
         probabilities = torch.exp(torch.tensor(step_rewards, dtype=self.dtype))
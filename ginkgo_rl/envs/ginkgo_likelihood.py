@@ -1,3 +1,4 @@
+import copy
 import numpy as np
 from gym import Env
 from gym.spaces import Discrete, Box, MultiDiscrete
@@ -5,7 +6,6 @@ import logging
 from showerSim.invMass_ginkgo import Simulator as GinkgoSim
 from showerSim.likelihood_invM import split_logLH as ginkgo_log_likelihood
 import torch
-import copy
 
 logger = logging.getLogger(__name__)
 
@@ -94,6 +94,7 @@ class GinkgoLikelihoodEnv(Env):
         self.state = None
         self.illegal_action_counter = 0
         self.is_leaf = None
+        self.state_version = 0  # Incremented whenever the state changes
 
         # Prepare simulator
         self.sim = self._init_sim()
@@ -119,11 +120,26 @@ class GinkgoLikelihoodEnv(Env):
     def get_state(self):
         return self.state
 
+    def clone(self):
+        """
+        Returns a copy of the environment that can be stepped independently. Unlike a deep copy, it shares the
+        simulator, the action and observation spaces, and the current jet dict (which the environment never modifies)
+        with the original, and only duplicates the mutable particle arrays.
+        """
+
+        clone = copy.copy(self)
+        clone.state, clone.is_leaf = self._copy(self.state), self._copy(self.is_leaf)
+        return clone
+
     def get_internal_state(self):
-        return (self.jet, self.n, self.state, self.is_leaf, self.illegal_action_counter)
+        return (self.jet, self.n, self._copy(self.state), self._copy(self.is_leaf), self.illegal_action_counter)
 
     def set_internal_state(self, internal_state):
-        self.jet, self.n, self.state, self.is_leaf, self.illegal_action_counter = copy.deepcopy(internal_state)
+        # The jet dict is never modified by the environment, so we only need to copy the mutable particle arrays
+        jet, n, state, is_leaf, illegal_action_counter = internal_state
+        self.jet, self.n, self.illegal_action_counter = jet, n, illegal_action_counter
+        self.state, self.is_leaf = self._copy(state), self._copy(is_leaf)
+        self.state_version += 1
 
     def step(self, action):
         """ Environment step. """
@@ -194,6 +210,22 @@ class GinkgoLikelihoodEnv(Env):
 
         return self.state, reward, done, info
 
+    def step_many(self, actions):
+        """
+        Performs a sequence of environment steps, stopping early if the episode ends. Returns the final state, the total
+        reward, and whether the episode is done.
+        """
+
+        total_reward, done = 0.0, False
+
+        for action in actions:
+            _, reward, done, _ = self.step(action)
+            total_reward += reward
+            if done:
+                break
+
+        return self.state, total_reward, done
+
     def render(self, mode="human"):
         """ Visualize / report what's happening """
 
@@ -249,6 +281,7 @@ class GinkgoLikelihoodEnv(Env):
 
             success = True
 
+        self.state_version += 1
         if self.verbose:
             logger.debug(f"Sampled new jet with {self.n} leaves")
 
@@ -269,33 +302,43 @@ class GinkgoLikelihoodEnv(Env):
     def _compute_log_likelihood(self, action):
         """ Compute log likelihood of the splitting (i + j) -> i, j, where i, j is the current action """
 
-        assert self.check_legality(action)
-        i, j = action
+        return self._compute_log_likelihoods([action])[0]
+
+    def _compute_log_likelihoods(self, actions):
+        """
+        Compute log likelihoods of a list of splittings (each given as a tuple (i, j)) in the current state.
+
+        The state is not changed, and the quantities that only depend on the state (rescaled momenta, virtualities, and
+        the splitting parameters) are computed once for all actions.
+        """
+
+        momenta = self.state / self.state_rescaling
+        virtualities = self._compute_virtualities(momenta)
 
-        ti, tj = self._compute_virtuality(i), self._compute_virtuality(j)
         t_cut = self.jet["pt_cut"]
         lam = self.jet["Lambda"]
         if self.n == 2 and self.w_jet:
             lam = self.jet["LambdaRoot"]  # W jets have a different lambda for the first split
 
-        log_likelihood = ginkgo_log_likelihood(
-            self.state[i] / self.state_rescaling, ti, self.state[j] / self.state_rescaling, tj, t_cut=t_cut, lam=lam
-        )
-        try:
-            log_likelihood = log_likelihood.item()
-        except:
-            pass
-
-        if self.min_reward is not None:
-            log_likelihood = np.clip(log_likelihood, self.min_reward, None)
+        log_likelihoods = np.empty(len(actions), dtype=np.float64)
+        for k, action in enumerate(actions):
+            assert self.check_legality(action)
+            i, j = action
 
-        if self.verbose:
-            logger.debug(
-                f"Computing log likelihood of action {action}: ti = {ti}, tj = {tj}, t_cut = {t_cut}, lam = {lam} -> log likelihood = {log_likelihood}"
+            log_likelihood = ginkgo_log_likelihood(
+                momenta[i], virtualities[i], momenta[j], virtualities[j], t_cut=t_cut, lam=lam
             )
-            # logger.debug(f"Computing log likelihood of action {action}: log likelihood = {log_likelihood}")
+            log_likelihoods[k] = float(np.asarray(log_likelihood).reshape(-1)[0])  # Might be a tensor or of shape (1,)
+
+            if self.verbose:
+                logger.debug(
+                    f"Computing log likelihood of action {action}: ti = {virtualities[i]}, tj = {virtualities[j]}, t_cut = {t_cut}, lam = {lam} -> log likelihood = {log_likelihoods[k]}"
+                )
+
+        if self.min_reward is not None:
+            log_likelihoods = np.clip(log_likelihoods, self.min_reward, None)
 
-        return log_likelihood
+        return log_likelihoods
 
     def _merge(self, action):
         """ Perform action, updating self.n and self.state """
@@ -318,6 +361,7 @@ class GinkgoLikelihoodEnv(Env):
 
         self.n -= 1
         self._sort_state()
+        self.state_version += 1
 
         if self.verbose:
             logger.debug(f"Merging particles {i} and {j}. New state has {self.n} particles.")
@@ -326,13 +370,15 @@ class GinkgoLikelihoodEnv(Env):
         """ Checks if the current episode is done, i.e. if the clustering has reduced all particles to a single one """
         return self.n <= self.n_target
 
-    def _compute_virtuality(self, i):
-        """ Computes the virtuality t of particle i """
-        if self.is_leaf[i]:
-            return 0.0  # See discussion with Sebastian
+    def _compute_virtualities(self, momenta):
+        """ Computes the virtualities t of all particles, given their rescaled momenta """
+        virtualities = momenta[:, 0] ** 2 - momenta[:, 1] ** 2 - momenta[:, 2] ** 2 - momenta[:, 3] ** 2
+        virtualities[np.asarray(self.is_leaf, dtype=bool)] = 0.0  # See discussion with Sebastian
+        return virtualities
 
-        p = self.state[i, :] / self.state_rescaling
-        return p[0] ** 2 - p[1] ** 2 - p[2] ** 2 - p[3] ** 2
+    @staticmethod
+    def _copy(array):
+        return None if array is None else np.array(array, copy=True)
 
     def _draw_random_legal_action(self):
         assert not self._check_if_done() and self.n > 1
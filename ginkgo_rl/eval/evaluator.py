@@ -3,8 +3,10 @@ import numpy as np
 from matplotlib import pyplot as plt
 import sys
 import os
-from tqdm import trange
+from tqdm import tqdm
 import pickle
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import logging
 import torch
 
@@ -70,22 +72,34 @@ class GinkgoEvaluator:
         self._update_results(method, log_likelihoods, illegal_actions)
         return log_likelihoods, illegal_actions, likelihood_evaluations
 
-    def eval(self, method, model, n_repeats=1, mode=None):
+    def eval(self, method, model, n_repeats=1, mode=None, n_workers=1):
+        """
+        Evaluates a model on all jets. With n_workers > 1, the episodes are distributed over that many forked worker
+        processes, each with its own copy of the environment and the model.
+        """
+
         log_likelihoods = [[] for _ in range(self.n_jets)]
         illegal_actions = [[] for _ in range(self.n_jets)]
         likelihood_evaluations = [[] for _ in range(self.n_jets)]
 
-        model.eval()
-
-        for i in trange(len(self.jets) * n_repeats):
-            i_jet = i // n_repeats
-            jet = self.jets[i_jet]
+        if model is not None:
+            model.eval()
 
-            self.env.set_internal_state(jet)
+        n_episodes = len(self.jets) * n_repeats
+        if n_workers > 1 and not self._can_fork():
+            logger.warning(
+                f"Parallel evaluation needs forked worker processes, which are not available (or not safe) on platform "
+                f"{sys.platform}. Evaluating in the main process instead of {n_workers} workers."
+            )
+            n_workers = 1
 
-            with torch.no_grad():
-                log_likelihood, error, likelihood_evaluation = self._episode(model, mode=mode)
+        if n_workers > 1:
+            results = self._eval_parallel(model, n_repeats, mode, n_workers)
+        else:
+            results = (self._eval_episode(self.jets[i // n_repeats], model, mode) for i in range(n_episodes))
 
+        for i, (log_likelihood, error, likelihood_evaluation) in enumerate(tqdm(results, total=n_episodes)):
+            i_jet = i // n_repeats
             log_likelihoods[i_jet].append(log_likelihood)
             illegal_actions[i_jet].append(error)
             likelihood_evaluations[i_jet].append(likelihood_evaluation)
@@ -93,8 +107,8 @@ class GinkgoEvaluator:
         self._update_results(method, log_likelihoods, illegal_actions)
         return log_likelihoods, illegal_actions, likelihood_evaluations
 
-    def eval_random(self, method, n_repeats=1):
-        return self.eval(method, None, n_repeats)
+    def eval_random(self, method, n_repeats=1, n_workers=1):
+        return self.eval(method, None, n_repeats, n_workers=n_workers)
 
     def get_jet_info(self):
         return {"n_leaves": np.array([len(jet[0]["leaves"]) for jet in self.jets], dtype=np.int)}
@@ -234,6 +248,27 @@ class GinkgoEvaluator:
 
         return jets
 
+    def _eval_episode(self, jet, model, mode=None):
+        self.env.set_internal_state(jet)
+        with torch.no_grad():
+            return self._episode(model, mode=mode)
+
+    @staticmethod
+    def _can_fork():
+        """ Whether worker processes can be forked (not available on Windows, unsafe with system libraries on macOS) """
+        return "fork" in multiprocessing.get_all_start_methods() and sys.platform != "darwin"
+
+    def _eval_parallel(self, model, n_repeats, mode, n_workers):
+        """ Runs the evaluation episodes in forked worker processes, yields the results in the original order """
+
+        # With fork, the evaluator (including env and model) is inherited by the workers and never pickled
+        context = multiprocessing.get_context("fork")
+        with ProcessPoolExecutor(
+            max_workers=n_workers, mp_context=context, initializer=_init_eval_worker, initargs=(self, model, mode)
+        ) as executor:
+            jets = (jet for jet in self.jets for _ in range(n_repeats))
+            yield from executor.map(_eval_worker_episode, jets)
+
     def _episode(self, model, mode=None):
         state = self.env.get_state()
         done = False
@@ -316,3 +351,15 @@ class GinkgoEvaluator:
             n -= 1
 
         return evaluations
+
+
+_eval_worker = {}  # Evaluator, model, and mode inherited by each evaluation worker process
+
+
+def _init_eval_worker(evaluator, model, mode):
+    torch.set_num_threads(1)  # The workers already use all cores between them
+    _eval_worker.update(evaluator=evaluator, model=model, mode=mode)
+
+
+def _eval_worker_episode(jet):
+    return _eval_worker["evaluator"]._eval_episode(jet, _eval_worker["model"], _eval_worker["mode"])
@@ -1,17 +1,82 @@
 import random
-from collections import OrderedDict
 
 import numpy as np
 import torch
 
+from ginkgo_rl.utils.mcts_kernels import puct_argmax, beam_topk
 from ginkgo_rl.utils.normalization import AffineNormalizer
 
+_NODE_POOL = []  # Released nodes that can be recycled by MCTSNode.acquire()
+_NODE_POOL_MAX_SIZE = 100000  # About ten times the size of a typical tree
+
+# Shared (read-only) child arrays of unexpanded nodes
+_NO_CHILDREN_FLOAT = np.zeros(0, dtype=np.float64)
+_NO_CHILDREN_FLOAT.flags.writeable = False
+_NO_CHILDREN_INT = np.zeros(0, dtype=np.int64)
+_NO_CHILDREN_INT.flags.writeable = False
+
+
+class _RootStatistics:
+    """ Holds the statistics of a tree root, which (unlike all other nodes) has no parent to store them """
+
+    def __init__(self, q=0.0, n=0, q_max=-float("inf"), q_step=None, virtual_n=0):
+        self.child_q = np.array([q], dtype=np.float64)
+        self.child_n = np.array([n], dtype=np.int64)
+        self.child_q_max = np.array([q_max], dtype=np.float64)
+        self.child_q_step = np.array([np.nan if q_step is None else q_step], dtype=np.float64)
+        self.child_virtual_n = np.array([virtual_n], dtype=np.int64)
+
 
 class MCTSNode:
-    def __init__(self, parent, path, reward_normalizer=None, reward_min=None, reward_max=None, q_step=None):
+    """
+    Node in the MCTS tree.
+
+    The statistics of all children of a node (visit counts, rewards, ...) are stored in contiguous arrays in the
+    parent node (`child_q`, `child_n`, ...), so the selection rules can be evaluated with a few array operations.
+    The child nodes themselves are only created when they are visited for the first time.
+
+    To avoid allocating lots of short-lived objects, nodes of discarded trees can be returned to a pool with
+    `MCTSNode.release_tree()` and are then recycled by `MCTSNode.acquire()`.
+    """
+
+    def __init__(
+        self, parent, path, reward_normalizer=None, reward_min=None, reward_max=None, q_step=None, index=None
+    ):
+        self._init(parent, path, reward_normalizer, reward_min, reward_max, q_step, index)
+
+    @classmethod
+    def acquire(
+        cls, parent, path, reward_normalizer=None, reward_min=None, reward_max=None, q_step=None, index=None
+    ):
+        """ Like the constructor, but recycles a released node if one is available """
+        if not _NODE_POOL:
+            return cls(parent, path, reward_normalizer, reward_min, reward_max, q_step, index)
+
+        node = _NODE_POOL.pop()
+        node._init(parent, path, reward_normalizer, reward_min, reward_max, q_step, index)
+        return node
+
+    @staticmethod
+    def release_tree(root):
+        """ Returns all nodes of a (sub)tree to the pool. The nodes must not be used afterwards. """
+        queue = [root]
+        while queue:
+            node = queue.pop()
+            queue.extend(child for child in node.child_nodes if child is not None)
+
+            node._clear()
+            if len(_NODE_POOL) < _NODE_POOL_MAX_SIZE:
+                _NODE_POOL.append(node)
+
+    def _init(self, parent, path, reward_normalizer, reward_min, reward_max, q_step, index):
         self.parent = parent
         self.path = path
-        self.children = OrderedDict()
+
+        # Where the statistics of this node are stored: the parent's child arrays, or a separate root container
+        if parent is None:
+            self._owner, self._index = _RootStatistics(q_step=q_step), 0
+        else:
+            self._owner, self._index = parent, index
 
         self.reward_min = reward_min
         self.reward_max = reward_max
@@ -22,47 +87,138 @@ class MCTSNode:
         )
 
         self.terminal = None  # None means undetermined
-        self.n = 0  # Total visit count
-        self.q = 0.0  # Total reward collected during playing out any trajectories that go through this state
-        self.q_max = -float("inf")  # Highest reward encountered in this node
-
-        self.q_step = q_step  # Reward received for the transition self.parent -> self
+        self.expanded = False
         self.n_beamsearch = 0  # Flag for beam search
 
+        # Children
+        self.legal_actions = []  # Actions leading to the children, available after expansion
+        self.child_nodes = []  # Child nodes, None until they are visited for the first time
+        self.child_q = _NO_CHILDREN_FLOAT  # See q
+        self.child_n = _NO_CHILDREN_INT  # See n
+        self.child_q_max = _NO_CHILDREN_FLOAT  # See q_max
+        self.child_q_step = _NO_CHILDREN_FLOAT  # See q_step
+        self.child_virtual_n = _NO_CHILDREN_INT  # See virtual_n
+        self._child_index = {}  # Position of each action in the child arrays
+
+        self.snapshot = None  # Cached internal state of the environment at this node
+        self.state = None  # Cached (tensorized) environment state at this node
+        self.total_reward = None  # Cached reward collected since the beginning of the episode
+
+    def _clear(self):
+        """ Drops all references held by a node, so that a pooled node does not keep a tree or its caches alive """
+        self.parent, self.path, self._owner, self.reward_normalizer = None, None, None, None
+        self.legal_actions, self.child_nodes, self._child_index = [], [], {}
+        self.child_q = self.child_q_max = self.child_q_step = _NO_CHILDREN_FLOAT
+        self.child_n = self.child_virtual_n = _NO_CHILDREN_INT
+        self.snapshot, self.state = None, None
+
+    @property
+    def n(self):
+        """ Total visit count """
+        return int(self._owner.child_n[self._index])
+
+    @property
+    def q(self):
+        """ Total reward collected during playing out any trajectories that go through this state """
+        return float(self._owner.child_q[self._index])
+
+    @property
+    def q_max(self):
+        """ Highest reward encountered in this node """
+        return float(self._owner.child_q_max[self._index])
+
+    @property
+    def q_step(self):
+        """ Reward received for the transition self.parent -> self (NaN if unknown) """
+        return float(self._owner.child_q_step[self._index])
+
+    @property
+    def virtual_n(self):
+        """ Number of MCTS descents through this node that are still in flight (virtual loss) """
+        return int(self._owner.child_virtual_n[self._index])
+
     def expand(self, actions, step_rewards=None):
         self.terminal = False
 
+        if self.expanded:
+            return
+
         if step_rewards is None:
             step_rewards = [None for action in actions]
 
-        for action, reward in zip(actions, step_rewards):
-            if action in self.children:
-                continue
-
-            self.children[action] = MCTSNode(
+        n_children = len(actions)
+        self.expanded = True
+        self.legal_actions = list(actions)
+        self.child_nodes = [None for _ in actions]
+        self.child_q = np.zeros(n_children, dtype=np.float64)
+        self.child_n = np.zeros(n_children, dtype=np.int64)
+        self.child_q_max = np.full(n_children, -float("inf"), dtype=np.float64)
+        self.child_q_step = np.array([np.nan if r is None else r for r in step_rewards], dtype=np.float64)
+        self.child_virtual_n = np.zeros(n_children, dtype=np.int64)
+        self._child_index = {action: i for i, action in enumerate(self.legal_actions)}
+
+    def child(self, action):
+        """ Returns the child node reached by an action, creating it if necessary """
+        i = self._child_index[action]
+        node = self.child_nodes[i]
+
+        if node is None:
+            node = MCTSNode.acquire(
                 self,
                 self.path + [action],
                 self.reward_normalizer,
                 reward_min=self.reward_min,
                 reward_max=self.reward_max,
-                q_step=reward,
+                index=i,
             )
+            self.child_nodes[i] = node
+
+        return node
 
     def set_terminal(self, terminal):
         self.terminal = terminal
 
-    def give_reward(self, reward, backup=True, beamsearch=False):
-        reward = np.clip(reward, self.reward_min, self.reward_max)
-
-        self.q_max = max(self.q_max, reward)
-        self.q += reward
-        self.n += 1
-        self.reward_normalizer.update(reward)
-        if beamsearch:
-            self.n_beamsearch += 1
+    def cache(self, snapshot, state, total_reward, terminal):
+        """ Stores the environment state at this node, so that the path to it does not have to be simulated again """
+        self.snapshot = snapshot
+        self.state = state
+        self.total_reward = total_reward
+        self.terminal = terminal
 
-        if backup and self.parent:
-            self.parent.give_reward(reward, backup=True, beamsearch=beamsearch)
+    def give_reward(self, reward, backup=True, beamsearch=False, remove_virtual_loss=False):
+        nodes = [self]
+        if backup:
+            while nodes[-1].parent is not None:
+                nodes.append(nodes[-1].parent)
+
+        self.backup(nodes, reward, beamsearch=beamsearch, remove_virtual_loss=remove_virtual_loss)
+
+    @staticmethod
+    def backup(nodes, reward, beamsearch=False, remove_virtual_loss=False):
+        """ Gives a reward to a list of nodes (usually a node and its ancestors) in a single iterative pass """
+        if not nodes:
+            return
+
+        reward = float(np.clip(reward, nodes[0].reward_min, nodes[0].reward_max))
+        normalizer = None
+
+        for node in nodes:
+            owner, i = node._owner, node._index
+            owner.child_q_max[i] = max(owner.child_q_max[i], reward)
+            owner.child_q[i] += reward
+            owner.child_n[i] += 1
+            if beamsearch:
+                node.n_beamsearch += 1
+            if remove_virtual_loss:
+                owner.child_virtual_n[i] -= 1
+
+            if node.reward_normalizer is not normalizer:  # All nodes of a tree usually share one normalizer
+                normalizer = node.reward_normalizer
+                normalizer.update(reward)
+
+    def add_virtual_loss(self, n=1):
+        """ Marks a node as visited by n MCTS descents that have not been backed up yet """
+        self._owner.child_virtual_n[self._index] += n
 
     def get_reward(self, mode="mean"):
         """ Returns normalized mean reward (for `mode=="mean"`) or best reward (for `mode=="max"`) """
@@ -81,77 +237,80 @@ class MCTSNode:
             else:
                 return 0.5
 
+    def children_rewards(self, mode="mean"):
+        """ Returns the normalized mean or best rewards of all children, like calling get_reward() on each of them """
+        assert mode in ["mean", "max"]
+
+        if mode == "max":
+            try:
+                return self.reward_normalizer.evaluate(self.child_q_max)
+            except TypeError:  # Happens with un-initializded normalizer
+                return np.full(len(self), 0.5)
+        else:
+            rewards = np.full(len(self), self.get_reward(mode))  # Unvisited children fall back to this node
+            visited = self.child_n > 0
+            if np.any(visited):
+                rewards[visited] = self.reward_normalizer.evaluate(self.child_q[visited] / self.child_n[visited])
+            return rewards
+
     def children_q_steps(self):
-        return [child.q_step for child in self.children.values()]
+        return self.child_q_step
 
     def select_random(self):
-        assert self.children and not self.terminal
-        return random.choice(list(self.children.keys()))
+        assert len(self) > 0 and not self.terminal
+        return random.choice(self.legal_actions)
 
     def select_puct(self, policy_probs=None, mode="mean", c_puct=1.0):
-        assert self.children and not self.terminal
+        assert len(self) > 0 and not self.terminal
 
-        pucts = self._compute_pucts(policy_probs, mode=mode, c_puct=c_puct)
-        assert len(pucts) > 0
+        if policy_probs is None:  # By default assume a uniform policy
+            policy_probs = np.full(len(self), 1.0 / len(self))
+        elif isinstance(policy_probs, torch.Tensor):
+            policy_probs = policy_probs.detach().cpu().numpy()
+        assert len(policy_probs) == len(self)
 
-        # Pick highest
-        best_puct = -float("inf")
-        choice = None
-        for i, puct in enumerate(pucts):
-            if puct > best_puct or choice is None:
-                best_puct = puct
-                choice = i
+        # Rewards in the precision of the policy, so that ties are resolved consistently
+        q_children = self.children_rewards(mode=mode).astype(policy_probs.dtype)
+        n_parent = self.n + int(np.sum(self.child_virtual_n))
 
-        assert choice is not None
-        return list(self.children.keys())[choice]
+        # Pick highest (first one in case of ties)
+        choice = puct_argmax(q_children, self.child_n, self.child_virtual_n, policy_probs, n_parent, float(c_puct))
+        return self.legal_actions[choice]
 
     def select_best(self, mode="max"):
-        best_q = -float("inf")
-        choice = None
-
-        for action, child in self.children.items():
-            q = child.get_reward(mode=mode)
-            if q > best_q or choice is None:
-                best_q = q
-                choice = action
-
-        assert choice is not None
-        return choice
+        assert len(self) > 0
+        return self.legal_actions[int(np.argmax(self.children_rewards(mode=mode)))]
 
     def select_beam_search(self, beam_size):
-        choices = sorted(list(self.children.keys()), key=lambda x: self.children[x].q_step, reverse=True)[:beam_size]
-        return choices
+        choices = beam_topk(self.child_q_step, beam_size)
+        return [self.legal_actions[i] for i in choices]
 
     def select_greedy(self):
         choices = self.select_beam_search(1)
         return 0 if not choices else choices[0]
 
     def prune(self):
-        """ Steps into a subtree and updates all paths (and the new root's parent link) """
-        self.path = self.path[1:]
-        if len(self.path) == 0:
-            self.parent = None
-
-        for child in self.children.values():
-            child.prune()
-
-    def _compute_pucts(self, policy_probs=None, mode="mean", c_puct=1.0):
-        if policy_probs is None:  # By default assume a uniform policy
-            policy_probs = 1.0 / len(self)
-
-        assert len(policy_probs) == len(self) > 0
-
-        n_children = torch.tensor([child.n for child in self.children.values()], dtype=policy_probs.dtype)
-        q_children = torch.tensor(
-            [child.get_reward(mode=mode) for child in self.children.values()], dtype=policy_probs.dtype
+        """
+        Makes this node the root of the tree: updates all paths in its subtree and releases the previous root with all
+        other branches to the node pool.
+        """
+
+        old_root, index = self.parent, self._index
+        self._owner, self._index = (
+            _RootStatistics(q=self.q, n=self.n, q_max=self.q_max, q_step=self.q_step, virtual_n=self.virtual_n),
+            0,
         )
-        pucts = q_children + c_puct * policy_probs * (self.n + 1.0e-9) ** 0.5 / (1.0 + n_children)
+        self.parent = None
 
-        assert len(n_children) == len(self) > 0
-        assert len(q_children) == len(self) > 0
-        assert len(pucts) == len(self) > 0
+        if old_root is not None:
+            old_root.child_nodes[index] = None  # Detach this subtree before releasing the rest
+            MCTSNode.release_tree(old_root)
 
-        return pucts
+        queue = [self]
+        while queue:
+            node = queue.pop()
+            node.path = node.path[1:]
+            queue.extend(child for child in node.child_nodes if child is not None)
 
     def __len__(self):
-        return len(self.children)
+        return len(self.legal_actions)
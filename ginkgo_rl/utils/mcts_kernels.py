@@ -0,0 +1,72 @@
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+try:
+    from numba import njit
+
+    NUMBA_AVAILABLE = True
+except ImportError:
+    logger.warning("Error importing numba, falling back to NumPy implementation of MCTS selection kernels.")
+    NUMBA_AVAILABLE = False
+
+
+def _puct_argmax_loop(q, n, virtual_n, probs, n_parent, c_puct):
+    """
+    Index of the child with the highest PUCT score, explicit loop for compilation with numba.
+
+    All arithmetic is done in the precision of q and probs (which need to have the same dtype), exactly like in the
+    NumPy version, so both implementations pick the same child.
+    """
+    real = q.dtype.type
+    one = real(1)
+    c_puct = real(c_puct)
+    sqrt_n_parent = real((n_parent + 1.0e-9) ** 0.5)
+
+    best, best_puct = 0, real(0)
+    for i in range(len(q)):
+        n_i, virtual_n_i = real(n[i]), real(virtual_n[i])
+        n_total = n_i + virtual_n_i
+        q_i = q[i]
+        if virtual_n[i] > 0:  # Virtual loss: in-flight descents count as visits with the worst (normalized) reward
+            q_i = q_i * n_i / max(n_total, one)
+        puct = q_i + c_puct * probs[i] * sqrt_n_parent / (one + n_total)
+
+        if i == 0 or puct > best_puct:  # First one in case of ties
+            best, best_puct = i, puct
+
+    return best
+
+
+def _puct_argmax_numpy(q, n, virtual_n, probs, n_parent, c_puct):
+    """ Index of the child with the highest PUCT score, vectorized with NumPy (in the precision of q and probs) """
+    real = probs.dtype.type
+    n = n.astype(probs.dtype)
+    virtual_n = virtual_n.astype(probs.dtype)
+    n_total = n + virtual_n
+    q = np.where(virtual_n > 0, q * n / np.maximum(n_total, real(1)), q)
+    pucts = q + real(c_puct) * probs * real((n_parent + 1.0e-9) ** 0.5) / (real(1) + n_total)
+    return int(np.argmax(pucts))
+
+
+def _beam_topk(q_step, k):
+    """ Indices of the k children with the highest step rewards, in descending order (stable in case of ties) """
+    return np.argsort(-q_step, kind="mergesort")[:k]
+
+
+if NUMBA_AVAILABLE:
+    puct_argmax = njit(cache=True)(_puct_argmax_loop)
+    beam_topk = njit(cache=True)(_beam_topk)
+else:
+    puct_argmax = _puct_argmax_numpy
+    beam_topk = _beam_topk
+
+
+def warm_up():
+    """ Calls the kernels once for every argument type used in the tree search, so that numba compiles them early """
+    for dtype in (np.float32, np.float64):
+        q = np.zeros(2, dtype=dtype)
+        n = np.zeros(2, dtype=np.int64)
+        puct_argmax(q, n, n, np.full(2, 0.5, dtype=dtype), 0, 1.0)
+    beam_topk(np.zeros(2, dtype=np.float64), 1)
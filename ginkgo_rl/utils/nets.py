@@ -130,7 +130,9 @@ class MultiHeadedMLP(nn.Module):
 
     def forward(self, inputs):
         latent = self.latent_net(inputs)
-        outputs = [head(latent) for head in self.head_nets]
+        outputs = []
+        for head in self.head_nets:  # Explicit loop (rather than a comprehension) keeps this compatible with TorchScript
+            outputs.append(head(latent))
         return outputs
 
 